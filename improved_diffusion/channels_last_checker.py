@@ -1,80 +1,296 @@
+import os
+import sys
+import weakref
+from contextlib import contextmanager
+
 import torch
+from torch.utils._pytree import tree_flatten
+
+try:
+    from torch.overrides import TorchFunctionMode
+except ImportError:  # torch < 1.13
+    TorchFunctionMode = None
+
+# when off, wrapped ops call straight through; set CHECK_CL=1 (or call enable()) to patch and check
+_ENABLED = os.environ.get("CHECK_CL", "0") == "1"
+# flipped by the first channels_last tensor a wrapped op takes or returns; until then wrappers only look for one.
+# reset by disable() and on leaving check_channels_last()
+_ANY_CL_SEEN = False
+# raise instead of printing when an op drops channels_last
+RAISE_ON_FAILURE = bool(int(os.environ.get("CHECK_CL_RAISE", "0")))
+
+# (id(t), t._version) -> (weakref to t, was channels_last); the weakref guards against id reuse
+_cl_cache = dict()
+_CL_CACHE_SIZE = 4096
+
+
+def _is_cl4(t):
+    # channels_last stride invariant (c*h*w, 1, w*c, c); size-1 dims may carry any stride
+    s = t.stride()
+    if len(s) != 4:
+        return False
+    shape = t.shape
+    # unit channel stride is the cheapest test and rejects nearly every non-channels_last tensor
+    if s[1] != 1 and shape[1] != 1:
+        return False
+    n, c, h, w = shape
+    return (w == 1 or s[3] == c) and (h == 1 or s[2] == c * w) and (n == 1 or s[0] == c * h * w)
+
+
+def _leaf_is_cl(t):
+    # cheap rejects before touching the cache: only 4D tensors with unit channel stride can qualify
+    if t.ndim != 4 or t.stride(1) != 1:
+        return False
+    try:
+        key = (id(t), t._version)
+    except RuntimeError:
+        # inference tensors don't track a version counter
+        key = None
+    if key is not None:
+        hit = _cl_cache.get(key)
+        if hit is not None and hit[0]() is t:
+            return hit[1]
+
+    # channels_last but not plain contiguous: the two layouts only coincide when c == 1 or h * w == 1
+    out = _is_cl4(t) and t.shape[1] > 1 and t.shape[2] * t.shape[3] > 1
+
+    if key is not None:
+        if len(_cl_cache) > _CL_CACHE_SIZE:
+            _cl_cache.clear()
+        _cl_cache[key] = (weakref.ref(t), out)
+    return out
+
 
 def contains_cl(args):
-    for t in args:
-        if isinstance(t, torch.Tensor):
-            if t.is_contiguous(memory_format=torch.channels_last) and not t.is_contiguous():
-                return True
-        elif isinstance(t, list) or isinstance(t, tuple):
-            if contains_cl(list(t)):
-                return True
-    return False
+    leaves, _ = tree_flatten(args)
+    is_tensor = torch.Tensor
+    return any(isinstance(t, is_tensor) and _leaf_is_cl(t) for t in leaves)
+
+
+_TENSOR_FMT = "{} {} {} {} {}\n"
 
 
 def print_inputs(args, indent=""):
-    for t in args:
-        if isinstance(t, torch.Tensor):
-            print(indent, t.stride(), t.shape, t.device, t.dtype)
-        elif isinstance(t, list) or isinstance(t, tuple):
-            print(indent, type(t))
-            print_inputs(list(t), indent=indent + "    ")
+    buf = []
+    stack = [(iter(args), indent)]
+    while stack:
+        items, ind = stack[-1]
+        for t in items:
+            if isinstance(t, torch.Tensor):
+                buf.append(_TENSOR_FMT.format(ind, t.stride(), tuple(t.shape), t.device, t.dtype))
+            elif isinstance(t, (list, tuple)):
+                buf.append(ind + " " + t.__class__.__name__ + "\n")
+                stack.append((iter(t), ind + "    "))
+                break
+            else:
+                buf.append(f"{ind} {t}\n")
         else:
-            print(indent, t)
+            stack.pop()
+    sys.stdout.write("".join(buf))
 
 
-def check_wrapper(fn):
+def _dump(hdr_inputs, args):
+    print(hdr_inputs)
+    print_inputs(args)
+
+
+def _make_checker(fn):
     name = fn.__name__ if hasattr(fn, '__name__') else 'noname__' + repr(fn)
+    hdr_inputs = f"`{name}` inputs are:"
+    hdr_badout = f"`{name}` got channels_last input, but output is not channels_last:"
+    hdr_lost = f"Operator `{name}` lost channels_last property"
 
-    def check_cl(*args, **kwargs):
+    def checked(args, kwargs):
         was_cl = contains_cl(args)
         try:
             result = fn(*args, **kwargs)
-        except Exception as e:
-            print("`{}` inputs are:".format(name))
-            print_inputs(args)
+        except Exception:
+            _dump(hdr_inputs, args)
             print("-------------------")
-            raise e
+            raise
         failed = False
         if was_cl:
-            if isinstance(result, torch.Tensor):
-                if result.dim() == 4 and not result.is_contiguous(memory_format=torch.channels_last):
+            # ops like split/chunk/max return tuples; check their tensor elements too, one level deep
+            for r in (result if isinstance(result, tuple) else (result,)):
+                if type(r) is torch.Tensor and r.ndim == 4 and not _is_cl4(r):
                     print(
-                        "`{}` got channels_last input, but output is not channels_last:".format(name),
-                        result.shape,
-                        result.stride(),
-                        result.device,
-                        result.dtype,
+                        hdr_badout,
+                        r.shape,
+                        r.stride(),
+                        r.device,
+                        r.dtype,
                     )
                     failed = True
-        if failed and True:
-            print("`{}` inputs are:".format(name))
-            print_inputs(args)
-            msg = "Operator `{}` lost channels_last property".format(name)
-            if False:
-                raise Exception(msg)
-            print(msg)
+        if failed:
+            _dump(hdr_inputs, args)
+            if RAISE_ON_FAILURE:
+                raise RuntimeError(hdr_lost)
+            print(hdr_lost)
         return result
 
+    return checked
+
+
+def check_wrapper(fn):
+    checked = _make_checker(fn)
+
+    def check_cl(*args, **kwargs):
+        global _ANY_CL_SEEN
+        if not _ENABLED:
+            return fn(*args, **kwargs)
+        if not _ANY_CL_SEEN:
+            # arm on channels_last inputs too, since they may come from outside the wrappers
+            # (creation ops, Module.to(memory_format=...), external inputs) and the op may drop the layout
+            if contains_cl(args):
+                _ANY_CL_SEEN = True
+                return checked(args, kwargs)
+            result = fn(*args, **kwargs)
+            if isinstance(result, torch.Tensor) and _leaf_is_cl(result):
+                _ANY_CL_SEEN = True
+            return result
+        return checked(args, kwargs)
+
     return check_cl
 
 
-old_attrs = dict()
+if TorchFunctionMode is not None:
+    class CLCheckMode(TorchFunctionMode):
+        """
+        Check channels_last propagation through __torch_function__ dispatch instead of patching
+        torch, torch.Tensor and torch.nn.functional. Covers every op, e.g.
+
+            with CLCheckMode():
+                model(x)
+        """
+
+        def __init__(self):
+            super().__init__()
+            self._checkers = dict()
+
+        def __torch_function__(self, func, types, args=(), kwargs=None):
+            checked = self._checkers.get(func)
+            if checked is None:
+                checked = self._checkers[func] = _make_checker(func)
+            return checked(args, kwargs or {})
+
+
+# ops with channels_last semantics: layout-changing views/copies, 4D conv/norm/pool/resample, pointwise binaries
+_CL_RELEVANT_TENSOR = frozenset((
+    "contiguous", "permute", "view", "view_as", "reshape", "reshape_as", "flatten", "unflatten",
+    "unsqueeze", "squeeze", "transpose", "expand", "expand_as", "repeat", "narrow", "chunk", "split", "as_strided",
+    "to", "type", "type_as", "float", "half", "bfloat16", "clone",
+    "add", "sub", "mul", "div", "add_", "sub_", "mul_", "div_", "where", "masked_fill",
+))
+_CL_RELEVANT_FUNCTIONAL = frozenset((
+    "conv2d", "conv_transpose2d", "batch_norm", "group_norm", "instance_norm", "layer_norm",
+    "max_pool2d", "avg_pool2d", "adaptive_avg_pool2d", "adaptive_max_pool2d",
+    "interpolate", "upsample", "pad",
+))
+_CL_RELEVANT_TORCH = frozenset((
+    "conv2d", "conv_transpose2d", "batch_norm", "group_norm", "layer_norm",
+    "cat", "stack", "split", "chunk", "permute", "reshape", "flatten", "transpose", "unsqueeze", "squeeze", "as_strided",
+    "add", "sub", "mul", "div", "where", "addcmul",
+))
+
+# creation ops take no tensor inputs and predicates / global state setters return no tensors,
+# so wrapping them can never catch anything
+_SKIP_TORCH = frozenset((
+    "zeros", "zeros_like", "ones", "ones_like", "empty", "empty_like", "empty_strided", "full", "full_like",
+    "rand", "rand_like", "randn", "randn_like", "randint", "randint_like", "randperm", "arange", "range",
+    "linspace", "logspace", "eye", "tensor", "as_tensor", "from_numpy", "frombuffer",
+    "equal", "allclose", "is_tensor", "is_storage", "is_floating_point", "is_complex", "is_nonzero",
+    "typename", "numel", "set_grad_enabled", "no_grad", "enable_grad", "inference_mode",
+    "is_grad_enabled", "manual_seed", "seed", "initial_seed", "get_rng_state", "set_rng_state",
+    "get_default_dtype", "set_default_dtype", "set_default_tensor_type", "set_printoptions",
+))
+# unary pointwise ops always keep their input's strides, and reductions don't produce 4D outputs from 4D inputs.
+# binary pointwise ops are deliberately not listed: with mixed-layout operands they can pick a contiguous output
+_PASS_THROUGH_POINTWISE = frozenset((
+    "abs", "neg", "sqrt", "rsqrt", "log", "exp", "sin", "cos", "tanh", "sigmoid", "relu", "relu_",
+    "gelu", "silu", "leaky_relu", "elu", "softplus", "clamp", "clamp_", "clip", "dropout", "square",
+    "reciprocal", "sign", "floor", "ceil", "round", "erf",
+))
+_DIM_COLLAPSING = frozenset((
+    "sum", "mean", "max", "min", "amax", "amin", "argmax", "argmin", "prod", "std", "var", "norm",
+    "logsumexp", "all", "any", "count_nonzero", "std_mean", "var_mean", "median", "quantile", "nansum", "nanmean",
+))
+# never patched, even when attribute() walks all of dir(m)
+_EXCLUDE = (
+    frozenset(("is_cuda", "has_names", "numel", "stride", "Tensor", "is_contiguous", "__class__"))
+    | _SKIP_TORCH
+    | _PASS_THROUGH_POINTWISE
+    | _DIM_COLLAPSING
+)
+
+# (module, name, original) for every patched attribute, in patch order
+_saved = []
+
+
+def attribute(m, whitelist=None):
+    names = dir(m) if whitelist is None else whitelist
+    for i in names:
+        if i.startswith("_") or i in _EXCLUDE:
+            continue
+        e = getattr(m, i, None)
+        if e is None or not callable(e):
+            continue
+        try:
+            setattr(m, i, check_wrapper(e))
+            _saved.append((m, i, e))
+        except Exception as e:
+            print(i)
+            print(e)
+
+
+def _attribute_all():
+    attribute(torch.Tensor, _CL_RELEVANT_TENSOR)
+    attribute(torch.nn.functional, _CL_RELEVANT_FUNCTIONAL)
+    attribute(torch, _CL_RELEVANT_TORCH)
+
+
+def enable():
+    global _ENABLED
+    _ENABLED = True
+    if not _saved:
+        _attribute_all()
+
+
+def disable():
+    global _ENABLED, _ANY_CL_SEEN
+    _ENABLED = False
+    _ANY_CL_SEEN = False
+
+
+def _restore():
+    for m, i, e in reversed(_saved):
+        setattr(m, i, e)
+    _saved.clear()
+
+
+@contextmanager
+def check_channels_last():
+    """
+    Check channels_last propagation only inside the block, e.g.
 
+        with check_channels_last():
+            train_step()
 
-def attribute(m):
-    old_attrs[m] = dict()
-    for i in dir(m):
-        e = getattr(m, i)
-        exclude_functions = ["is_cuda", "has_names", "numel", "stride", "Tensor", "is_contiguous", "__class__"]
-        if i not in exclude_functions and not i.startswith("_") and "__call__" in dir(e):
-            try:
-                old_attrs[m][i] = e
-                setattr(m, i, check_wrapper(e))
-            except Exception as e:
-                print(i)
-                print(e)
+    Ops are patched on enter and restored on exit, unless they were already patched by enable() / CHECK_CL=1.
+    """
+    global _ENABLED, _ANY_CL_SEEN
+    was_enabled, patched = _ENABLED, not _saved
+    if patched:
+        _attribute_all()
+    _ENABLED = True
+    try:
+        yield
+    finally:
+        _ENABLED = was_enabled
+        # a later scoped check starts unarmed again
+        _ANY_CL_SEEN = False
+        if patched:
+            _restore()
 
 
-attribute(torch.Tensor)
-attribute(torch.nn.functional)
-attribute(torch)
+if _ENABLED:
+    _attribute_all()
@@ -8,7 +8,7 @@ Docstrings have been added, as well as DDIM sampling and a new collection of bet
 import enum
 import math
 import random
-from functools import lru_cache
+from functools import lru_cache, partial
 
 import numpy as np
 import torch as th
@@ -17,6 +17,7 @@ from .nn import mean_flat
 from .losses import normal_kl, discretized_gaussian_log_likelihood
 
 
+@lru_cache(maxsize=32)
 def get_named_beta_schedule(schedule_name, num_diffusion_timesteps):
     """
     Get a pre-defined beta schedule for the given name.
@@ -25,6 +26,9 @@ def get_named_beta_schedule(schedule_name, num_diffusion_timesteps):
     in the limit of num_diffusion_timesteps.
     Beta schedules may be added, but should not be removed or changed once
     they are committed to maintain backwards compatibility.
+
+    Results are cached and shared between callers, so the returned array is
+    read-only; copy it before modifying.
     """
     if schedule_name == "linear":
         # Linear schedule from Ho et al, extended to work for any number of
@@ -32,16 +36,18 @@ def get_named_beta_schedule(schedule_name, num_diffusion_timesteps):
         scale = 1000 / num_diffusion_timesteps
         beta_start = scale * 0.0001
         beta_end = scale * 0.02
-        return np.linspace(
+        betas = np.linspace(
             beta_start, beta_end, num_diffusion_timesteps, dtype=np.float64
         )
     elif schedule_name == "cosine":
-        return betas_for_alpha_bar(
+        betas = betas_for_alpha_bar(
             num_diffusion_timesteps,
-            lambda t: math.cos((t + 0.008) / 1.008 * math.pi / 2) ** 2,
+            lambda t: np.cos((t + 0.008) / 1.008 * math.pi / 2) ** 2,
         )
     else:
         raise NotImplementedError(f"unknown beta schedule: {schedule_name}")
+    betas.setflags(write=False)
+    return betas
 
 
 def get_schedule_fn(schedule_name, num_diffusion_timesteps):
@@ -68,16 +74,164 @@ def betas_for_alpha_bar(num_diffusion_timesteps, alpha_bar, max_beta=0.999):
     :param num_diffusion_timesteps: the number of betas to produce.
     :param alpha_bar: a lambda that takes an argument t from 0 to 1 and
                       produces the cumulative product of (1-beta) up to that
-                      part of the diffusion process.
+                      part of the diffusion process. It is called once on an
+                      array of all the t values if it supports that, and per
+                      element otherwise.
     :param max_beta: the maximum beta to use; use values lower than 1 to
                      prevent singularities.
     """
-    betas = []
-    for i in range(num_diffusion_timesteps):
-        t1 = i / num_diffusion_timesteps
-        t2 = (i + 1) / num_diffusion_timesteps
-        betas.append(min(1 - alpha_bar(t2) / alpha_bar(t1), max_beta))
-    return np.array(betas)
+    t = np.arange(num_diffusion_timesteps + 1) / num_diffusion_timesteps
+    try:
+        alphas_bar = np.asarray(alpha_bar(t), dtype=np.float64)
+    except TypeError:
+        # scalar-only alpha_bar, e.g. one written with math.cos
+        alphas_bar = np.array([alpha_bar(x) for x in t.tolist()], dtype=np.float64)
+    return np.minimum(1 - alphas_bar[1:] / alphas_bar[:-1], max_beta)
+
+
+def _p_sample_tail(mean, log_variance, noise, nonzero_mask):
+    return mean + nonzero_mask * th.exp(0.5 * log_variance) * noise
+
+
+# the fuser turns the tail into one pass over memory; the plain function above is kept for th.compile
+_p_sample_tail_scripted = th.jit.script(_p_sample_tail)
+
+
+@th.jit.script
+def _transfer_core(xstart, eps, noise, coef_xstart, coef_eps, noise_scale):
+    return xstart * coef_xstart + coef_eps * eps + noise_scale * noise
+
+
+@th.jit.script
+def _q_sample_core(x_start, noise, sqrt_alpha_bar, sqrt_one_minus_alpha_bar):
+    return sqrt_alpha_bar * x_start + sqrt_one_minus_alpha_bar * noise
+
+
+@th.jit.script
+def _plms_combine(eps, eps_1, eps_2, eps_3):
+    # fourth order Adams-Bashforth predictor
+    return (55 * eps - 59 * eps_1 + 37 * eps_2 - 9 * eps_3) / 24
+
+
+# log-variance tables feed exp(); keep them float32 even when tensorizing to a lower precision dtype
+_FP32_SCHEDULE_ARRAYS = frozenset([
+    "posterior_log_variance_clipped", "log_betas", "log_one_minus_alphas_cumprod", "fixed_large_log_variance",
+])
+
+
+def _arrays_to_device(arrays, device, dtype):
+    """
+    Move a dict of numpy arrays to `device` as `dtype` with one host-to-device
+    copy, instead of one small copy per array.
+
+    :return: a dict of tensors, each a view into the single on-device buffer.
+    """
+    sizes = [arr.size for arr in arrays.values()]
+    staging = th.empty(sum(sizes), dtype=dtype, pin_memory=th.device(device).type == "cuda")
+    offset = 0
+    for arr, size in zip(arrays.values(), sizes):
+        staging[offset:offset + size].copy_(th.from_numpy(np.ascontiguousarray(arr).reshape(-1)))
+        offset += size
+    on_device = staging.to(device, non_blocking=True)
+    out, offset = {}, 0
+    for (name, arr), size in zip(arrays.items(), sizes):
+        out[name] = on_device[offset:offset + size].view(arr.shape)
+        offset += size
+    return out
+
+
+# converts nats to bits
+_INV_LOG2 = 1.0 / math.log(2.0)
+
+# steps of sampling noise drawn per randn call when a sampler needs noise at every step
+_NOISE_POOL_STEPS = 32
+
+# bound on _extract_many's memo; a sampling step only uses a few distinct (t, shape, names) combinations
+_EXTRACT_MEMO_SIZE = 64
+
+
+class TaylorCache:
+    """
+    Reuse model outputs across sampling steps, TaylorSeer-style: on steps where
+    `policy(i)` returns "reuse", the model is skipped and its output is
+    extrapolated to first order in the step index from the last two computed
+    outputs.
+
+    :param policy: a callable mapping a step index to "compute" or "reuse".
+    """
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.step = None
+        self.reuse = False
+        # [(step, model output)] for the last (at most two) computed steps, oldest first
+        self.history = []
+
+    def set_step(self, i):
+        self.step = i
+        self.reuse = bool(self.history) and self.policy(i) == "reuse"
+
+    def update(self, model_output):
+        # cloned, since the output may live in memory the model reuses (e.g. CUDA graph outputs)
+        self.history = self.history[-1:] + [(self.step, model_output.detach().clone())]
+
+    def predict(self):
+        s1, out1 = self.history[-1]
+        if len(self.history) < 2:
+            return out1
+        s0, out0 = self.history[0]
+        return out1 + ((self.step - s1) / (s1 - s0)) * (out1 - out0)
+
+
+class _AutocastModel:
+    """
+    Call a model under autocast to `dtype` on the device of its input.
+    Other attribute lookups are forwarded to the model.
+    """
+
+    def __init__(self, model, dtype):
+        self.model = model
+        self.dtype = dtype
+
+    def __call__(self, x, *args, **kwargs):
+        with th.autocast(device_type=x.device.type, dtype=self.dtype):
+            return self.model(x, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+
+class _EpsRing:
+    """
+    The last `size` eps predictions, oldest first, held in one preallocated
+    tensor that is written in place instead of a list of per-step tensors.
+    Indexing with -1 gives the newest entry, -2 the one before, and so on.
+    """
+
+    def __init__(self, size=3):
+        self.size = size
+        self.buf = None
+        self.head = 0
+
+    def append(self, eps):
+        n = eps.shape[0]
+        if self.buf is None:
+            # stacked along the batch dim so every slot keeps eps's memory layout
+            self.buf = eps.new_empty((self.size * n, *eps.shape[1:]))
+            if eps.dim() == 4 and not eps.is_contiguous() and eps.is_contiguous(memory_format=th.channels_last):
+                self.buf = self.buf.contiguous(memory_format=th.channels_last)
+        slot = self.head % self.size
+        self.buf[slot * n:(slot + 1) * n].copy_(eps)
+        self.head += 1
+
+    def __len__(self):
+        return min(self.head, self.size)
+
+    def __getitem__(self, k):
+        assert -len(self) <= k < 0, "only the most recent entries can be read, by negative index"
+        n = self.buf.shape[0] // self.size
+        slot = (self.head + k) % self.size
+        return self.buf[slot * n:(slot + 1) * n]
 
 
 class ModelMeanType(enum.Enum):
@@ -116,10 +270,20 @@ class LossType(enum.Enum):
     RESCALED_MSE_SNR_PLUS_ONE = enum.auto()
 
     def is_vb(self):
-        return self == LossType.KL or self == LossType.RESCALED_KL
+        return self in _VB_LOSSES
 
     def is_mse(self):
-        return self == LossType.MSE or self == LossType.RESCALED_MSE or self == LossType.RESCALED_MSE_BALANCED or LossType.RESCALED_MSE_V or self == LossType.RESCALED_MSE_SNR_PLUS_ONE
+        return self in _MSE_LOSSES
+
+
+_VB_LOSSES = frozenset([LossType.KL, LossType.RESCALED_KL])
+_MSE_LOSSES = frozenset([
+    LossType.MSE,
+    LossType.RESCALED_MSE,
+    LossType.RESCALED_MSE_BALANCED,
+    LossType.RESCALED_MSE_V,
+    LossType.RESCALED_MSE_SNR_PLUS_ONE,
+])
 
 
 class GaussianDiffusion:
@@ -137,6 +301,22 @@ class GaussianDiffusion:
     :param rescale_timesteps: if True, pass floating point timesteps into the
                               model so that they are always scaled like in the
                               original paper (0 to 1000).
+    :param compile_sampling: if True, fuse the elementwise tail of p_sample into
+                             one kernel with torch.compile (torch >= 2.0).
+    :param batch_guidance: if True, run the conditional and unconditional halves
+                           of classifier-free guidance as one doubled batch when
+                           their model kwargs allow it.
+    :param compile_model: if True, the sampling loops run the model through
+                          torch.compile(mode="reduce-overhead"), capturing the
+                          forward in CUDA graphs (torch >= 2.0). A string is
+                          used as the compile mode instead.
+    :param sampling_dtype: if not None (e.g. th.float16 or th.bfloat16), the
+                           sampling loops run the model under autocast to this
+                           dtype. The sampler's own arithmetic stays in the
+                           dtype of the sample and the schedule.
+    :param allow_tf32: if True, let CUDA matmuls and cuDNN convolutions use
+                       TF32 tensor cores. This sets the global torch.backends
+                       flags, so it affects all models in the process.
     """
 
     def __init__(
@@ -149,12 +329,30 @@ class GaussianDiffusion:
         rescale_timesteps=False,
         schedule_fn=None,
         vb_loss_ratio=1000.,
+        compile_sampling=False,
+        batch_guidance=True,
+        compile_model=False,
+        sampling_dtype=None,
+        allow_tf32=False,
     ):
         self.model_mean_type = model_mean_type
         self.model_var_type = model_var_type
         self.loss_type = loss_type
         self.rescale_timesteps = rescale_timesteps
         self.vb_loss_ratio = vb_loss_ratio
+        self.compile_sampling = compile_sampling
+        self._compiled_sample_tail = None
+        self.batch_guidance = batch_guidance
+        self.compile_model = compile_model
+        self.sampling_dtype = sampling_dtype
+        self.allow_tf32 = allow_tf32
+        if allow_tf32:
+            th.backends.cuda.matmul.allow_tf32 = True
+            th.backends.cudnn.allow_tf32 = True
+        # (model, compiled model) from the last _sampling_model call
+        self._compiled_model = None
+        # (cond kwargs, uncond kwargs, batched kwargs) from the last _batched_guidance_kwargs call
+        self._batched_kwargs_cache = None
 
         # Use float64 for accuracy.
         betas = np.array(betas, dtype=np.float64)
@@ -172,14 +370,20 @@ class GaussianDiffusion:
         self.alphas_cumprod_next = np.append(self.alphas_cumprod[1:], 0.0)
         assert self.alphas_cumprod_prev.shape == (self.num_timesteps,)
 
+        # the derived arrays below share these intermediates rather than recomputing them;
+        # each would otherwise be another full pass and allocation over the schedule
+        one_minus_alphas_cumprod = 1.0 - self.alphas_cumprod
+        one_minus_alphas_cumprod_prev = 1.0 - self.alphas_cumprod_prev
+        recip_alphas_cumprod = 1.0 / self.alphas_cumprod
+
         # calculations for diffusion q(x_t | x_{t-1}) and others
         self.sqrt_alphas_cumprod = np.sqrt(self.alphas_cumprod)
-        self.sqrt_one_minus_alphas_cumprod = np.sqrt(1.0 - self.alphas_cumprod)
-        self.log_one_minus_alphas_cumprod = np.log(1.0 - self.alphas_cumprod)
-        self.sqrt_recip_alphas_cumprod = np.sqrt(1.0 / self.alphas_cumprod)
-        self.sqrt_recipm1_alphas_cumprod = np.sqrt(1.0 / self.alphas_cumprod - 1)
+        self.sqrt_one_minus_alphas_cumprod = np.sqrt(one_minus_alphas_cumprod)
+        self.log_one_minus_alphas_cumprod = np.log(one_minus_alphas_cumprod)
+        self.sqrt_recip_alphas_cumprod = np.sqrt(recip_alphas_cumprod)
+        self.sqrt_recipm1_alphas_cumprod = np.sqrt(recip_alphas_cumprod - 1)
 
-        self.one_minus_alphas_cumprod = 1.0 - self.alphas_cumprod
+        self.one_minus_alphas_cumprod = one_minus_alphas_cumprod
 
         #  1/(snr + 1) = 1 - alpha_cumprod, percept paper eqn 4 comment
         self.recip_snrp1_clipped = np.clip(self.one_minus_alphas_cumprod, a_min=1e-2, a_max=None)
@@ -187,7 +391,7 @@ class GaussianDiffusion:
 
         # calculations for posterior q(x_{t-1} | x_t, x_0)
         self.posterior_variance = (
-            betas * (1.0 - self.alphas_cumprod_prev) / (1.0 - self.alphas_cumprod)
+            betas * one_minus_alphas_cumprod_prev / one_minus_alphas_cumprod
         )
         # log calculation clipped because the posterior variance is 0 at the
         # beginning of the diffusion chain.
@@ -195,19 +399,64 @@ class GaussianDiffusion:
             np.append(self.posterior_variance[1], self.posterior_variance[1:])
         )
         self.posterior_mean_coef1 = (
-            betas * np.sqrt(self.alphas_cumprod_prev) / (1.0 - self.alphas_cumprod)
+            betas * np.sqrt(self.alphas_cumprod_prev) / one_minus_alphas_cumprod
         )
         self.posterior_mean_coef2 = (
-            (1.0 - self.alphas_cumprod_prev)
+            one_minus_alphas_cumprod_prev
             * np.sqrt(alphas)
-            / (1.0 - self.alphas_cumprod)
+            / one_minus_alphas_cumprod
         )
+        # 0 at t == 0, where samplers add no noise, else 1
+        self.nonzero_mask = (np.arange(self.num_timesteps) != 0).astype(np.float64)
+
+        # for fixedlarge, we set the initial (log-)variance like so
+        # to get a better decoder log likelihood.
+        self.fixed_large_variance = np.append(self.posterior_variance[1], self.betas[1:])
+        self.fixed_large_log_variance = np.log(self.fixed_large_variance)
+
+        # for inverting the posterior mean, (xprev - coef2*x_t) / coef1
+        self.inv_posterior_mean_coef1 = 1.0 / self.posterior_mean_coef1
+        self.coef2_over_coef1 = self.posterior_mean_coef2 / self.posterior_mean_coef1
 
         self.schedule_fn = schedule_fn
 
-        self.snr = 1.0 / (1 - self.alphas_cumprod) - 1
+        self.snr = 1.0 / one_minus_alphas_cumprod - 1
 
         self.tensorized_for = None
+        # names of the schedule arrays, recorded by the first tensorize() since they are tensors afterwards
+        self._schedule_names = None
+        # rescaled model timestep for every t, filled in by tensorize()
+        self._scaled_timesteps = None
+        # (id(t), broadcast shape, names) -> (t, extracted tensors), see _extract_many
+        self._extract_memo = {}
+        # eta -> PRK step coefficient table, see _pair_coef_table
+        self._pair_coef_tables = {}
+        # (t, i): the batch of timesteps the current sampling step uses and the value they all hold
+        self._host_t = None
+
+        # unconditional_key -> (unconditional model output, number of model evaluations it has served)
+        self._uncond_cache = {}
+
+        # the mean / variance parameterization is fixed per instance, so pick its handlers once
+        # instead of dispatching on the enums in every p_mean_variance call
+        self._var_fn = {
+            ModelVarType.LEARNED: self._learned_variance,
+            ModelVarType.LEARNED_RANGE: self._learned_range_variance,
+            ModelVarType.FIXED_LARGE: partial(
+                self._fixed_variance, "fixed_large_variance", "fixed_large_log_variance"
+            ),
+            ModelVarType.FIXED_SMALL: partial(
+                self._fixed_variance, "posterior_variance", "posterior_log_variance_clipped"
+            ),
+        }[model_var_type]
+        mean_fns = {
+            ModelMeanType.PREVIOUS_X: self._mean_from_xprev,
+            ModelMeanType.START_X: self._mean_from_xstart,
+            ModelMeanType.EPSILON: self._mean_from_eps,
+        }
+        if model_mean_type not in mean_fns:
+            raise NotImplementedError(model_mean_type)
+        self._mean_fn = mean_fns[model_mean_type]
 
     def is_tensorized(self, device):
         # out = self.tensorized_for == device
@@ -218,13 +467,48 @@ class GaussianDiffusion:
         # return out
         return self.tensorized_for == device
 
-    def tensorize(self, device):
-        # print("GaussianDiffusion tensorize called")
-        arrays = {name: getattr(self, name) for name in vars(self) if isinstance(getattr(self, name), np.ndarray)}
+    # the schedule tensors are shared with training, so they must not become inference tensors
+    # when the first tensorize happens lazily inside a sampling loop
+    @th.inference_mode(False)
+    def tensorize(self, device, dtype=th.float):
+        """
+        Convert the numpy schedule arrays into torch tensors on `device`.
 
-        for name, arr in arrays.items():
-            setattr(self, name, th.from_numpy(arr).to(device=device, dtype=th.float))
+        :param dtype: the dtype of the schedule tensors. Passing the dtype of the
+                      sampling activations (e.g. th.bfloat16) keeps coefficient
+                      multiplies from upcasting them. Log-variance tables stay
+                      float32 regardless.
+        """
+        # print("GaussianDiffusion tensorize called")
+        if self._schedule_names is None:
+            self._schedule_names = tuple(name for name in vars(self) if isinstance(getattr(self, name), np.ndarray))
+
+        # numpy arrays go up in one copy per dtype; a repeat call (e.g. for another device) moves the tensors
+        by_dtype = {}
+        for name in self._schedule_names:
+            value = getattr(self, name)
+            arr_dtype = th.float if name in _FP32_SCHEDULE_ARRAYS else dtype
+            if isinstance(value, th.Tensor):
+                setattr(self, name, value.to(device=device, dtype=arr_dtype))
+            else:
+                by_dtype.setdefault(arr_dtype, {})[name] = value
+        for arr_dtype, group in by_dtype.items():
+            for name, tensor in _arrays_to_device(group, device, arr_dtype).items():
+                setattr(self, name, tensor)
+
+        # all per-timestep schedule arrays of the requested dtype, stacked as columns of one
+        # [num_timesteps, K] table, so that _extract_many can fetch the coefficients a step needs with a single gather
+        sched_names = [
+            name for name in self._schedule_names
+            if getattr(self, name).shape == (self.num_timesteps,) and getattr(self, name).dtype == dtype
+        ]
+        self._sched_cols = {name: k for k, name in enumerate(sched_names)}
+        self._sched = th.stack([getattr(self, name) for name in sched_names], dim=1)
+        if self.rescale_timesteps:
+            self._scaled_timesteps = th.arange(self.num_timesteps, device=device).float() * (1000.0 / self.num_timesteps)
 
+        self._extract_memo.clear()
+        self._pair_coef_tables.clear()
         self.tensorized_for = device
 
     def q_mean_variance(self, x_start, t):
@@ -235,14 +519,12 @@ class GaussianDiffusion:
         :param t: the number of diffusion steps (minus 1). Here, 0 means one step.
         :return: A tuple (mean, variance, log_variance), all of x_start's shape.
         """
-        mean = (
-            self._extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start
-        )
-        variance = self._extract_into_tensor(1.0 - self.alphas_cumprod, t, x_start.shape)
-        log_variance = self._extract_into_tensor(
-            self.log_one_minus_alphas_cumprod, t, x_start.shape
+        sqrt_alpha_bar, variance, log_variance = self._extract_many(
+            ("sqrt_alphas_cumprod", "one_minus_alphas_cumprod", "log_one_minus_alphas_cumprod"),
+            t, x_start.shape,
         )
-        return mean, variance, log_variance
+        mean = sqrt_alpha_bar * x_start
+        return mean, variance.expand(x_start.shape), log_variance.expand(x_start.shape)
 
     def q_sample(self, x_start, t, noise=None):
         """
@@ -258,11 +540,11 @@ class GaussianDiffusion:
         if noise is None:
             noise = th.randn_like(x_start)
         assert noise.shape == x_start.shape
-        return (
-            self._extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start
-            + self._extract_into_tensor(self.sqrt_one_minus_alphas_cumprod, t, x_start.shape)
-            * noise
+        coef_shape = (x_start.shape[0],) + (1,) * (x_start.dim() - 1)
+        sqrt_alpha_bar, sqrt_one_minus_alpha_bar = self._extract_many(
+            ("sqrt_alphas_cumprod", "sqrt_one_minus_alphas_cumprod"), t, coef_shape
         )
+        return _q_sample_core(x_start, noise, sqrt_alpha_bar, sqrt_one_minus_alpha_bar)
 
     def q_posterior_mean_variance(self, x_start, x_t, t):
         """
@@ -270,23 +552,26 @@ class GaussianDiffusion:
 
             q(x_{t-1} | x_t, x_0)
 
+        :return: A tuple (posterior_mean, posterior_variance,
+                 posterior_log_variance_clipped), all of x_start's shape.
         """
         assert x_start.shape == x_t.shape
-        posterior_mean = (
-            self._extract_into_tensor(self.posterior_mean_coef1, t, x_t.shape) * x_start
-            + self._extract_into_tensor(self.posterior_mean_coef2, t, x_t.shape) * x_t
-        )
-        posterior_variance = self._extract_into_tensor(self.posterior_variance, t, x_t.shape)
-        posterior_log_variance_clipped = self._extract_into_tensor(
-            self.posterior_log_variance_clipped, t, x_t.shape
+        coef1, coef2, posterior_variance, posterior_log_variance_clipped = self._extract_many(
+            ("posterior_mean_coef1", "posterior_mean_coef2", "posterior_variance", "posterior_log_variance_clipped"),
+            t, x_t.shape,
         )
+        posterior_mean = th.addcmul(coef1 * x_start, coef2, x_t)
         assert (
             posterior_mean.shape[0]
             == posterior_variance.shape[0]
             == posterior_log_variance_clipped.shape[0]
             == x_start.shape[0]
         )
-        return posterior_mean, posterior_variance, posterior_log_variance_clipped
+        return (
+            posterior_mean,
+            posterior_variance.expand(x_t.shape),
+            posterior_log_variance_clipped.expand(x_t.shape),
+        )
 
     def p_mean_variance(
         self, model, x, t, clip_denoised=True, denoised_fn=None, model_kwargs=None
@@ -320,68 +605,87 @@ class GaussianDiffusion:
         # are we doing clf free guide?
         guidance_scale = model_kwargs.get("guidance_scale", 0)
         unconditional_key = "unconditional_model_kwargs"
-        t_py = set(t.cpu().tolist())
-        if "txt_guidance_drop_ixs" in model_kwargs and (t_py.intersection(model_kwargs["txt_guidance_drop_ixs"]) != set()):
-            unconditional_key = "unconditional_drop_model_kwargs"
+        # the sampling loops announce the step they are on, which spares a device -> host copy of t here
+        t_host = self._host_step(t)
+        if "txt_guidance_drop_ixs" in model_kwargs:
+            t_py = {t_host} if t_host is not None else set(t.cpu().tolist())
+            if t_py.intersection(model_kwargs["txt_guidance_drop_ixs"]) != set():
+                unconditional_key = "unconditional_drop_model_kwargs"
         unconditional_model_kwargs = model_kwargs.get(unconditional_key)
         guidance_after_step = float(model_kwargs.get("guidance_after_step", 100000.))
         is_eps = self.model_mean_type == ModelMeanType.EPSILON
         effective_guidance_scale = th.where(t < guidance_after_step, float(guidance_scale), 0.)
-        can_skip = (effective_guidance_scale <= 0).all()
+        if t_host is not None:
+            can_skip = not (t_host < guidance_after_step and float(guidance_scale) > 0)
+        else:
+            can_skip = (effective_guidance_scale <= 0).all()
         # can_skip = False
         is_guided = (guidance_scale is not None) and (unconditional_model_kwargs is not None) and is_eps and (not can_skip)
         # print(f"is_guided {is_guided} | can_skip {can_skip} | guidance_scale {guidance_scale} | is_eps {is_eps}")
 
         drop_args = {
             "guidance_scale", "guidance_after_step", "unconditional_model_kwargs",
-            "unconditional_drop_model_kwargs", "txt_guidance_pdrop", "txt_guidance_drop_ixs"
+            "unconditional_drop_model_kwargs", "txt_guidance_pdrop", "txt_guidance_drop_ixs",
+            "uncond_cache_stride", "taylor_cache",
         }
         model_kwargs_cond = {k: v for k, v in model_kwargs.items() if k not in drop_args}
-        model_output = model(x, self._scale_timesteps(t), **model_kwargs_cond)
+        ts = self._scale_timesteps(t)
+
+        taylor_cache = model_kwargs.get("taylor_cache")
+        model_output, unconditional_model_output = None, None
+        if taylor_cache is not None and taylor_cache.reuse:
+            # the cached output already has guidance applied
+            model_output = taylor_cache.predict()
+            is_guided = False
+        elif is_guided:
+            # with uncond_cache_stride > 1, reuse the unconditional output across that many consecutive
+            # model evaluations, since it changes slowly between adjacent timesteps
+            uncond_cache_stride = int(model_kwargs.get("uncond_cache_stride", 0))
+            cached = self._uncond_cache.get(unconditional_key) if uncond_cache_stride > 1 else None
+            if cached is not None and cached[1] < uncond_cache_stride and cached[0].shape[0] == B:
+                unconditional_model_output = cached[0]
+                self._uncond_cache[unconditional_key] = (cached[0], cached[1] + 1)
+            else:
+                batched_kwargs = None
+                if self.batch_guidance:
+                    batched_kwargs = self._batched_guidance_kwargs(model_kwargs_cond, unconditional_model_kwargs, B)
+                if batched_kwargs is not None:
+                    # one forward over [cond; uncond] keeps the hardware busier than two half-size ones
+                    model_output, unconditional_model_output = th.chunk(
+                        model(th.cat([x, x]), th.cat([ts, ts]), **batched_kwargs), 2, dim=0
+                    )
+                else:
+                    unconditional_model_output = model(x, ts, **unconditional_model_kwargs)
+                if uncond_cache_stride > 1:
+                    # cloned: with compile_model, the output's memory is reused by the next graph replay
+                    self._uncond_cache[unconditional_key] = (unconditional_model_output.detach().clone(), 1)
+
+        if model_output is None:
+            model_output = model(x, ts, **model_kwargs_cond)
 
-        unconditional_model_output = None
         if is_guided:
-            unconditional_model_output = model(x, self._scale_timesteps(t), **unconditional_model_kwargs)
-
             # broadcast
             effective_guidance_scale = effective_guidance_scale.reshape([-1] + [1 for _ in model_output.shape[1:]])
 
             # print(effective_guidance_scale)
             model_output = (1 + effective_guidance_scale) * model_output - effective_guidance_scale * unconditional_model_output
 
+        if taylor_cache is not None and not taylor_cache.reuse:
+            if is_guided and self.model_var_type in [ModelVarType.LEARNED, ModelVarType.LEARNED_RANGE]:
+                # variance isn't guided; cache the unconditional variance half alongside the guided mean half
+                taylor_cache.update(th.cat([model_output[:, :C], unconditional_model_output[:, C:]], dim=1))
+            else:
+                taylor_cache.update(model_output)
+
         if self.model_var_type in [ModelVarType.LEARNED, ModelVarType.LEARNED_RANGE]:
             assert model_output.shape == (B, C * 2, *x.shape[2:])
             model_output, model_var_values = th.split(model_output, C, dim=1)
             if is_guided:
                 # don't guide variance
                 _, model_var_values = th.split(unconditional_model_output, C, dim=1)
-            if self.model_var_type == ModelVarType.LEARNED:
-                model_log_variance = model_var_values
-                model_variance = th.exp(model_log_variance)
-            else:
-                min_log = self._extract_into_tensor(
-                    self.posterior_log_variance_clipped, t, x.shape
-                )
-                max_log = self._extract_into_tensor(self.log_betas, t, x.shape)
-                # The model_var_values is [-1, 1] for [min_var, max_var].
-                frac = (model_var_values + 1) / 2
-                model_log_variance = frac * max_log + (1 - frac) * min_log
-                model_variance = th.exp(model_log_variance)
         else:
-            model_variance, model_log_variance = {
-                # for fixedlarge, we set the initial (log-)variance like so
-                # to get a better decoder log likelihood.
-                ModelVarType.FIXED_LARGE: (
-                    np.append(self.posterior_variance[1], self.betas[1:]),
-                    np.log(np.append(self.posterior_variance[1], self.betas[1:])),
-                ),
-                ModelVarType.FIXED_SMALL: (
-                    self.posterior_variance,
-                    self.posterior_log_variance_clipped,
-                ),
-            }[self.model_var_type]
-            model_variance = self._extract_into_tensor(model_variance, t, x.shape)
-            model_log_variance = self._extract_into_tensor(model_log_variance, t, x.shape)
+            model_var_values = None
+        model_variance, model_log_variance = self._var_fn(model_var_values, t, x.shape)
 
         def process_xstart(x):
             if denoised_fn is not None:
@@ -390,33 +694,7 @@ class GaussianDiffusion:
                 return x.clamp(-1, 1)
             return x
 
-        if self.model_mean_type == ModelMeanType.PREVIOUS_X:
-            pred_xstart = process_xstart(
-                self._predict_xstart_from_xprev(x_t=x, t=t, xprev=model_output)
-            )
-            model_mean = model_output
-        elif self.model_mean_type in [ModelMeanType.START_X, ModelMeanType.EPSILON]:
-            if self.model_mean_type == ModelMeanType.START_X:
-                pred_xstart = process_xstart(model_output)
-            else:
-                pred_xstart = process_xstart(
-                    self._predict_xstart_from_eps(x_t=x, t=t, eps=model_output)
-                )
-                # if is_guided:
-                #     unconditional_pred_xstart = process_xstart(
-                #         self._predict_xstart_from_eps(x_t=x, t=t, eps=unconditional_model_output)
-                #     )
-            model_mean, _, _ = self.q_posterior_mean_variance(
-                x_start=pred_xstart, x_t=x, t=t
-            )
-            # if is_guided:
-            #     # print(f'using guidance scale {guidance_scale}')
-            #     unconditional_model_mean, _, _ = self.q_posterior_mean_variance(
-            #         x_start=unconditional_pred_xstart, x_t=x, t=t
-            #     )
-            #     model_mean = (1 + guidance_scale) * model_mean - guidance_scale * unconditional_model_mean
-        else:
-            raise NotImplementedError(self.model_mean_type)
+        pred_xstart, model_mean = self._mean_fn(model_output, x, t, process_xstart)
 
         assert (
             model_mean.shape == model_log_variance.shape == pred_xstart.shape == x.shape
@@ -429,36 +707,135 @@ class GaussianDiffusion:
             "model_var_values": model_var_values
         }
 
+    def _learned_variance(self, model_var_values, t, broadcast_shape):
+        return th.exp(model_var_values), model_var_values
+
+    def _learned_range_variance(self, model_var_values, t, broadcast_shape):
+        min_log, max_log = self._extract_many(
+            ("posterior_log_variance_clipped", "log_betas"), t, broadcast_shape
+        )
+        # The model_var_values is [-1, 1] for [min_var, max_var].
+        frac = (model_var_values + 1) / 2
+        model_log_variance = frac * max_log + (1 - frac) * min_log
+        return th.exp(model_log_variance), model_log_variance
+
+    def _fixed_variance(self, variance_name, log_variance_name, model_var_values, t, broadcast_shape):
+        # p_mean_variance promises full-shape variances; expand only returns a view
+        variance, log_variance = self._extract_many((variance_name, log_variance_name), t, broadcast_shape)
+        return variance.expand(broadcast_shape), log_variance.expand(broadcast_shape)
+
+    def _mean_from_xprev(self, model_output, x, t, process_xstart):
+        pred_xstart = process_xstart(
+            self._predict_xstart_from_xprev(x_t=x, t=t, xprev=model_output)
+        )
+        return pred_xstart, model_output
+
+    def _mean_from_xstart(self, model_output, x, t, process_xstart):
+        pred_xstart = process_xstart(model_output)
+        model_mean, _, _ = self.q_posterior_mean_variance(
+            x_start=pred_xstart, x_t=x, t=t
+        )
+        return pred_xstart, model_mean
+
+    def _mean_from_eps(self, model_output, x, t, process_xstart):
+        pred_xstart = process_xstart(
+            self._predict_xstart_from_eps(x_t=x, t=t, eps=model_output)
+        )
+        model_mean, _, _ = self.q_posterior_mean_variance(
+            x_start=pred_xstart, x_t=x, t=t
+        )
+        return pred_xstart, model_mean
+
+    def _batched_guidance_kwargs(self, cond_kwargs, uncond_kwargs, batch_size):
+        """
+        Concatenate conditional and unconditional model kwargs along the batch
+        dimension, or return None if they can't be batched that way.
+
+        The result is reused for as long as the same kwarg tensors are passed in, so the
+        batched tensors stay the same objects across steps; the model's inference caches
+        (e.g. embed_capt_cached) are keyed on them.
+        """
+        if cond_kwargs.keys() != uncond_kwargs.keys():
+            return None
+        cached = self._batched_kwargs_cache
+        if (
+            cached is not None
+            and cached[0].keys() == cond_kwargs.keys()
+            and all(cached[0][k] is cond_kwargs[k] and cached[1][k] is uncond_kwargs[k] for k in cond_kwargs)
+        ):
+            return cached[2]
+
+        batched = {}
+        for k, v_c in cond_kwargs.items():
+            v_u = uncond_kwargs[k]
+            if not (isinstance(v_c, th.Tensor) and isinstance(v_u, th.Tensor)):
+                return None
+            if v_c.shape != v_u.shape or v_c.dtype != v_u.dtype or v_c.shape[:1] != (batch_size,):
+                return None
+            batched[k] = th.cat([v_c, v_u], dim=0)
+        self._batched_kwargs_cache = (dict(cond_kwargs), dict(uncond_kwargs), batched)
+        return batched
+
     def _predict_xstart_from_eps(self, x_t, t, eps):
         assert x_t.shape == eps.shape
-        return (
-            self._extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t
-            - self._extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape) * eps
+        sqrt_recip, sqrt_recipm1 = self._extract_many(
+            ("sqrt_recip_alphas_cumprod", "sqrt_recipm1_alphas_cumprod"), t, x_t.shape
         )
+        return th.addcmul(sqrt_recip * x_t, sqrt_recipm1, eps, value=-1)
 
     def _predict_xstart_from_xprev(self, x_t, t, xprev):
         assert x_t.shape == xprev.shape
-        return (  # (xprev - coef2*x_t) / coef1
-            self._extract_into_tensor(1.0 / self.posterior_mean_coef1, t, x_t.shape) * xprev
-            - self._extract_into_tensor(
-                self.posterior_mean_coef2 / self.posterior_mean_coef1, t, x_t.shape
-            )
-            * x_t
+        inv_coef1, coef2_over_coef1 = self._extract_many(
+            ("inv_posterior_mean_coef1", "coef2_over_coef1"), t, x_t.shape
         )
+        # (xprev - coef2*x_t) / coef1
+        return th.addcmul(inv_coef1 * xprev, coef2_over_coef1, x_t, value=-1)
 
     def _predict_eps_from_xstart(self, x_t, t, pred_xstart):
-        return (
-            self._extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t
-            - pred_xstart
-        ) / self._extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape)
+        sqrt_recip, sqrt_recipm1 = self._extract_many(
+            ("sqrt_recip_alphas_cumprod", "sqrt_recipm1_alphas_cumprod"), t, x_t.shape
+        )
+        return (sqrt_recip * x_t - pred_xstart) / sqrt_recipm1
+
+    def _sample_tail(self):
+        if not self.compile_sampling:
+            return _p_sample_tail_scripted
+        if self._compiled_sample_tail is None:
+            self._compiled_sample_tail = th.compile(_p_sample_tail, fullgraph=True, dynamic=False)
+        return self._compiled_sample_tail
+
+    def _end_sampling(self):
+        # drop per-call state, so a long-lived diffusion object doesn't keep the last call's tensors alive
+        self._uncond_cache.clear()
+        self._batched_kwargs_cache = None
+        self._host_t = None
+
+    def _sampling_model(self, model):
+        if self.compile_model:
+            if self._compiled_model is None or self._compiled_model[0] is not model:
+                mode = self.compile_model if isinstance(self.compile_model, str) else "reduce-overhead"
+                self._compiled_model = (model, th.compile(model, mode=mode, fullgraph=False))
+            model = self._compiled_model[1]
+        if self.sampling_dtype is not None:
+            model = _AutocastModel(model, self.sampling_dtype)
+        return model
+
+    def _match_model_layout(self, model, img):
+        # a UNet built with channels_last_mem converts its activations on every call; starting the sample
+        # in that layout makes the conversion a no-op and keeps the elementwise sampling math in one layout
+        if img.ndim == 4 and getattr(model, "channels_last_mem", False):
+            return img.contiguous(memory_format=th.channels_last)
+        return img
 
     def _scale_timesteps(self, t):
         if self.rescale_timesteps:
+            if self._scaled_timesteps is not None and self._scaled_timesteps.device == t.device:
+                return self._scaled_timesteps[t]
             return t.float() * (1000.0 / self.num_timesteps)
         return t
 
     def p_sample(
-        self, model, x, t, clip_denoised=True, denoised_fn=None, model_kwargs=None
+        self, model, x, t, clip_denoised=True, denoised_fn=None, model_kwargs=None, noise=None
     ):
         """
         Sample x_{t-1} from the model at the given timestep.
@@ -471,6 +848,9 @@ class GaussianDiffusion:
             x_start prediction before it is used to sample.
         :param model_kwargs: if not None, a dict of extra keyword arguments to
             pass to the model. This can be used for conditioning.
+        :param noise: if not None, a buffer shaped like x that is refilled with
+                      standard normal noise in place, instead of allocating
+                      a new noise tensor.
         :return: a dict containing the following keys:
                  - 'sample': a random sample from the model.
                  - 'pred_xstart': a prediction of x_0.
@@ -483,11 +863,9 @@ class GaussianDiffusion:
             denoised_fn=denoised_fn,
             model_kwargs=model_kwargs,
         )
-        noise = th.randn_like(x)
-        nonzero_mask = (
-            (t != 0).float().view(-1, *([1] * (len(x.shape) - 1)))
-        )  # no noise when t == 0
-        sample = out["mean"] + nonzero_mask * th.exp(0.5 * out["log_variance"]) * noise
+        noise = th.randn_like(x) if noise is None else noise.normal_()
+        nonzero_mask, = self._extract_many(("nonzero_mask",), t, x.shape)  # no noise when t == 0
+        sample = self._sample_tail()(out["mean"], out["log_variance"], noise, nonzero_mask)
         return {"sample": sample, "pred_xstart": out["pred_xstart"]}
 
     def p_sample_loop(
@@ -500,6 +878,7 @@ class GaussianDiffusion:
         model_kwargs=None,
         device=None,
         progress=False,
+        cache_policy=None,
     ):
         """
         Generate samples from the model.
@@ -516,6 +895,10 @@ class GaussianDiffusion:
         :param device: if specified, the device to create the samples on.
                        If not specified, use a model parameter's device.
         :param progress: if True, show a tqdm progress bar.
+        :param cache_policy: if not None, a callable mapping a step index to
+                             "compute" or "reuse"; on "reuse" steps the model
+                             is skipped and its output extrapolated from the
+                             previous computed steps (see TaylorCache).
         :return: a non-differentiable batch of samples.
         """
         final = None
@@ -528,6 +911,7 @@ class GaussianDiffusion:
             model_kwargs=model_kwargs,
             device=device,
             progress=progress,
+            cache_policy=cache_policy,
         ):
             final = sample
         return final["sample"]
@@ -542,25 +926,46 @@ class GaussianDiffusion:
         model_kwargs=None,
         device=None,
         progress=False,
+        cache_policy=None,
+        copy_to_cpu=False,
     ):
         """
         Generate samples from the model and yield intermediate samples from
         each timestep of diffusion.
 
-        Arguments are the same as p_sample_loop().
+        Arguments are the same as p_sample_loop(), plus:
+
+        :param copy_to_cpu: if True, also copy every yielded sample to the CPU
+                            as 'sample_cpu'. On CUDA the copy runs on a side
+                            stream so it overlaps the next step; wait on the
+                            'sample_cpu_ready' event before reading it.
         Returns a generator over dicts, where each dict is the return value of
         p_sample().
         """
         if device is None:
             device = model.device
+        model = self._sampling_model(model)
         assert isinstance(shape, (tuple, list))
         if noise is not None:
             img = noise
         else:
             img = th.randn(*shape, device=device)
+        img = self._match_model_layout(model, img)
+        self._uncond_cache.clear()
+        # refilled in place by every step rather than allocating fresh noise each time
+        noise_buf = th.empty_like(img)
+
+        taylor_cache = None
+        if cache_policy is not None:
+            taylor_cache = TaylorCache(cache_policy)
+            model_kwargs = dict(model_kwargs or {}, taylor_cache=taylor_cache)
+
+        copy_stream = None
+        if copy_to_cpu and th.device(device).type == "cuda":
+            copy_stream = th.cuda.Stream(device=device)
 
         trange = ts_index_range(shape[0], self.num_timesteps, device=device)
-        indices = list(range(self.num_timesteps))[::-1]
+        indices = _sampling_indices(self.num_timesteps, 0, 1)
 
         if progress:
             # Lazy import so that we don't depend on tqdm.
@@ -568,20 +973,42 @@ class GaussianDiffusion:
 
             indices = tqdm(indices)
 
-        for i in indices:
-            # t = th.tensor([i] * shape[0], device=device)
-            t = trange[i]
-            with th.no_grad():
-                out = self.p_sample(
-                    model,
-                    img,
-                    t,
-                    clip_denoised=clip_denoised,
-                    denoised_fn=denoised_fn,
-                    model_kwargs=model_kwargs,
-                )
+        try:
+            for i in indices:
+                # t = th.tensor([i] * shape[0], device=device)
+                t = trange[i]
+                self._host_t = (t, i)
+                if taylor_cache is not None:
+                    taylor_cache.set_step(i)
+                with th.inference_mode():
+                    out = self.p_sample(
+                        model,
+                        img,
+                        t,
+                        clip_denoised=clip_denoised,
+                        denoised_fn=denoised_fn,
+                        model_kwargs=model_kwargs,
+                        noise=noise_buf,
+                    )
+                    if copy_stream is not None:
+                        sample = out["sample"]
+                        copy_stream.wait_stream(th.cuda.current_stream(sample.device))
+                        with th.cuda.stream(copy_stream):
+                            # pinned destination, so the copy is truly asynchronous
+                            out["sample_cpu"] = th.empty(
+                                sample.shape, dtype=sample.dtype, pin_memory=True
+                            ).copy_(sample, non_blocking=True)
+                            out["sample_cpu_ready"] = th.cuda.Event()
+                            out["sample_cpu_ready"].record(copy_stream)
+                        # keep the allocator from reusing sample's memory before the copy is done
+                        sample.record_stream(copy_stream)
+                    elif copy_to_cpu:
+                        out["sample_cpu"] = out["sample"].cpu()
+                # yield outside inference mode so it doesn't leak into the caller's code
                 yield out
                 img = out["sample"]
+        finally:
+            self._end_sampling()
 
     def ddim_sample(
         self,
@@ -592,6 +1019,7 @@ class GaussianDiffusion:
         denoised_fn=None,
         model_kwargs=None,
         eta=0.0,
+        noise=None,
     ):
         """
         Sample x_{t-1} from the model using DDIM.
@@ -609,23 +1037,23 @@ class GaussianDiffusion:
         # Usually our model outputs epsilon, but we re-derive it
         # in case we used x_start or x_prev prediction.
         eps = self._predict_eps_from_xstart(x, t, out["pred_xstart"])
-        alpha_bar = self._extract_into_tensor(self.alphas_cumprod, t, x.shape)
-        alpha_bar_prev = self._extract_into_tensor(self.alphas_cumprod_prev, t, x.shape)
+        alpha_bar, alpha_bar_prev, nonzero_mask = self._extract_many(
+            ("alphas_cumprod", "alphas_cumprod_prev", "nonzero_mask"), t, x.shape
+        )
         sigma = (
             eta
             * th.sqrt((1 - alpha_bar_prev) / (1 - alpha_bar))
             * th.sqrt(1 - alpha_bar / alpha_bar_prev)
         )
         # Equation 12.
-        noise = th.randn_like(x)
-        mean_pred = (
-            out["pred_xstart"] * th.sqrt(alpha_bar_prev)
-            + th.sqrt(1 - alpha_bar_prev - sigma ** 2) * eps
+        noise = th.randn_like(x) if noise is None else noise.normal_()
+        mean_pred = th.addcmul(
+            out["pred_xstart"] * th.sqrt(alpha_bar_prev),
+            th.sqrt(1 - alpha_bar_prev - sigma ** 2),
+            eps,
         )
-        nonzero_mask = (
-            (t != 0).float().view(-1, *([1] * (len(x.shape) - 1)))
-        )  # no noise when t == 0
-        sample = mean_pred + nonzero_mask * sigma * noise
+        # no noise when t == 0
+        sample = mean_pred.addcmul_(nonzero_mask * sigma, noise)
         return {"sample": sample, "pred_xstart": out["pred_xstart"]}
 
     def ddim_reverse_sample(
@@ -652,16 +1080,16 @@ class GaussianDiffusion:
         )
         # Usually our model outputs epsilon, but we re-derive it
         # in case we used x_start or x_prev prediction.
-        eps = (
-            self._extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x.shape) * x
-            - out["pred_xstart"]
-        ) / self._extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x.shape)
-        alpha_bar_next = self._extract_into_tensor(self.alphas_cumprod_next, t, x.shape)
+        sqrt_recip, sqrt_recipm1, alpha_bar_next = self._extract_many(
+            ("sqrt_recip_alphas_cumprod", "sqrt_recipm1_alphas_cumprod", "alphas_cumprod_next"), t, x.shape
+        )
+        eps = (sqrt_recip * x - out["pred_xstart"]) / sqrt_recipm1
 
         # Equation 12. reversed
-        mean_pred = (
-            out["pred_xstart"] * th.sqrt(alpha_bar_next)
-            + th.sqrt(1 - alpha_bar_next) * eps
+        mean_pred = th.addcmul(
+            out["pred_xstart"] * th.sqrt(alpha_bar_next),
+            th.sqrt(1 - alpha_bar_next),
+            eps,
         )
 
         return {"sample": mean_pred, "pred_xstart": out["pred_xstart"]}
@@ -679,6 +1107,7 @@ class GaussianDiffusion:
         eta=0.0,
         ddim_fallback=False,
         use_model_var=True,
+        noise=None,
     ):
         def model_step(x_, t_):
             out = self.p_mean_variance(
@@ -698,8 +1127,10 @@ class GaussianDiffusion:
             if clip_denoised:
                 xstart = xstart.clamp(-1, 1)
 
-            alpha_bar_t1 = self._extract_into_tensor(self.alphas_cumprod, t1_, x.shape)
-            alpha_bar_t2 = self._extract_into_tensor(self.alphas_cumprod, t2_, x.shape)
+            # per-sample coefficients stay [B, 1, ...]; _transfer_core broadcasts them
+            coef_shape = (x.shape[0],) + (1,) * (len(x.shape) - 1)
+            alpha_bar_t1, = self._extract_many(("alphas_cumprod",), t1_, coef_shape)
+            alpha_bar_t2, = self._extract_many(("alphas_cumprod",), t2_, coef_shape)
 
             frac = (model_var_values + 1) / 2
             if use_model_var:
@@ -721,12 +1152,14 @@ class GaussianDiffusion:
             coef_xstart = th.sqrt(alpha_bar_t2)
             coef_eps = th.sqrt(1 - alpha_bar_t2 - sigma ** 2)
 
-            mean_pred = xstart * coef_xstart + coef_eps * eps
-            noise = th.randn_like(x_)
-            nonzero_mask = (
-                (t1_ != 0).float().view(-1, *([1] * (len(x_.shape) - 1)))
-            )  # no noise when t == 0
-            sample = mean_pred + nonzero_mask * sigma * noise
+            # no noise when t == 0
+            deterministic = not use_model_var and eta == 0.0
+            noise_scale = None if deterministic else self._nonzero_noise_scale(sigma, t1_, coef_shape)
+            if noise_scale is None:
+                # deterministic step: the noise term is all zeros, so don't draw noise just to multiply it away
+                return th.addcmul(xstart * coef_xstart, coef_eps, eps), xstart
+            step_noise = th.randn_like(x_) if noise is None else noise.normal_()
+            sample = _transfer_core(xstart, eps, step_noise, coef_xstart, coef_eps, noise_scale)
 
             return sample, xstart
 
@@ -735,7 +1168,7 @@ class GaussianDiffusion:
         if ddim_fallback:
             eps_prime = eps
         else:
-            eps_prime = (55 * eps - 59 * old_eps[-1] + 37 * old_eps[-2] - 9 * old_eps[-3]) / 24
+            eps_prime = _plms_combine(eps, old_eps[-1], old_eps[-2], old_eps[-3])
         # eps_prime = eps  # debug
         x_new, pred = transfer(x, eps_prime, t, t2, model_var_values)
         return {"sample": x_new, "pred_xstart": pred, 'eps': eps}
@@ -750,7 +1183,14 @@ class GaussianDiffusion:
         model_kwargs=None,
         eta=0.0,
         ddim_fallback=False,
+        noise=None,
     ):
+        """
+        Take one PRK step from t to t - 2.
+
+        :param noise: if not None, pre-drawn standard normal noise shaped like x
+                      for the final (stochastic) transfer; only used when eta > 0.
+        """
         def model_step(x_, t_):
             out = self.p_mean_variance(
                 model,
@@ -763,29 +1203,20 @@ class GaussianDiffusion:
             eps = self._predict_eps_from_xstart(x_, t_, out["pred_xstart"])
             return eps
 
-        def transfer(x_, eps, t1_, t2_, eta_=0.0):
-            xstart = self._predict_xstart_from_eps(x_, t1_, eps)
+        def transfer(x_, eps, coefs, eta_=0.0):
+            xstart = self._predict_xstart_from_eps(x_, t1, eps)
             if clip_denoised:
                 xstart = xstart.clamp(-1, 1)
 
-            alpha_bar_t1 = self._extract_into_tensor(self.alphas_cumprod, t1_, x.shape)
-            alpha_bar_t2 = self._extract_into_tensor(self.alphas_cumprod, t2_, x.shape)
-
-            sigma = (
-                eta_
-                * th.sqrt((1 - alpha_bar_t2) / (1 - alpha_bar_t1))
-                * th.sqrt(1 - alpha_bar_t1 / alpha_bar_t2)
-            )
-
-            coef_xstart = th.sqrt(alpha_bar_t2)
-            coef_eps = th.sqrt(1 - alpha_bar_t2 - sigma ** 2)
-
-            mean_pred = xstart * coef_xstart + coef_eps * eps
-            noise = th.randn_like(x_)
-            nonzero_mask = (
-                (t1_ != 0).float().view(-1, *([1] * (len(x_.shape) - 1)))
-            )  # no noise when t == 0
-            sample = mean_pred + nonzero_mask * sigma * noise
+            coef_xstart, coef_eps, sigma = coefs
+            # no noise when t == 0
+            noise_scale = None if eta_ == 0.0 else self._nonzero_noise_scale(sigma, t1, sigma.shape)
+            if noise_scale is None:
+                # deterministic step: the noise term is all zeros, so don't draw noise just to multiply it away
+                return th.addcmul(xstart * coef_xstart, coef_eps, eps), xstart
+            # only the final transfer is stochastic, so at most one draw per double step
+            step_noise = th.randn_like(x_) if noise is None else noise
+            sample = _transfer_core(xstart, eps, step_noise, coef_xstart, coef_eps, noise_scale)
 
             return sample, xstart
 
@@ -795,27 +1226,96 @@ class GaussianDiffusion:
 
         eps1 = model_step(x, t1)
 
+        if ddim_fallback and eta == 0.0:
+            # plain deterministic DDIM step from t1 to t2: only two coefficients matter
+            xstart = self._predict_xstart_from_eps(x, t1, eps1)
+            if clip_denoised:
+                xstart = xstart.clamp(-1, 1)
+            coef_xstart, coef_eps = self._pair_coef_table(0.0)[:, 1, :2].index_select(0, t1).unbind(1)
+            coef_shape = (-1,) + (1,) * (len(x.shape) - 1)
+            x_new = th.addcmul(xstart * coef_xstart.view(coef_shape), coef_eps.view(coef_shape), eps1)
+            return {"sample": x_new, "pred_xstart": xstart, 'eps': eps1}
+
+        end_coefs = self._pair_coefs(t1, 2, eta, x.shape)
+
         if ddim_fallback:
             eps_prime = eps1
         else:
-            x1, _ = transfer(x, eps1, t1, t_mid)
+            # the intermediate transfers are deterministic and two of them share the (t1, t_mid) step
+            mid_coefs = self._pair_coefs(t1, 1, 0.0, x.shape)
+            x1, _ = transfer(x, eps1, mid_coefs)
 
             eps2 = model_step(x1, t_mid)
-            x2, _ = transfer(x, eps2, t1, t_mid)
+            x2, _ = transfer(x, eps2, mid_coefs)
 
             eps3 = model_step(x2, t_mid)
-            x3, _ = transfer(x, eps3, t1, t2)
+            x3, _ = transfer(x, eps3, end_coefs if eta == 0.0 else self._pair_coefs(t1, 2, 0.0, x.shape))
 
             eps4 = model_step(x3, t2)
 
             eps_prime = (eps1 + 2 * eps2 + 2 * eps3 + eps4) / 6
         # eps_prime = eps1
-        x_new, pred = transfer(x, eps_prime, t1, t2, eta_=eta)
+        x_new, pred = transfer(x, eps_prime, end_coefs, eta_=eta)
         # eps_prime = eps1  # debug
         # x_new, pred = transfer(x, eps_prime, t1, t_mid)  # debug
 
         return {"sample": x_new, "pred_xstart": pred, 'eps': eps_prime}
 
+    def _pair_coefs(self, t1, gap, eta, broadcast_shape):
+        """
+        Coefficients of a DDIM-style step from t1 to t1 - gap, as used by the PRK transfers.
+
+        :param gap: 1 or 2.
+        :return: a tuple (coef_xstart, coef_eps, sigma) of [batch_size, 1, ...]
+                 tensors with as many dims as broadcast_shape.
+        """
+        if not self.is_tensorized(t1.device):
+            self.tensorize(t1.device)
+        rows = self._pair_coef_table(eta)[:, gap - 1].index_select(0, t1)
+        rows = rows.view(*rows.shape, *([1] * (len(broadcast_shape) - 1)))
+        return rows[:, 0], rows[:, 1], rows[:, 2]
+
+    def _host_step(self, t):
+        # the step index the sampling loops announced for t, or None when t didn't come from them
+        if self._host_t is not None and self._host_t[0] is t:
+            return self._host_t[1]
+        return None
+
+    def _nonzero_noise_scale(self, sigma, t, coef_shape):
+        """
+        Zero sigma where t == 0. Returns sigma itself when the loops say t is
+        a nonzero step, and None when they say it is step 0.
+        """
+        t_host = self._host_step(t)
+        if t_host is not None:
+            return sigma if t_host != 0 else None
+        nonzero_mask, = self._extract_many(("nonzero_mask",), t, coef_shape)
+        return nonzero_mask * sigma
+
+    def _pair_coef_table(self, eta):
+        """
+        A [num_timesteps, 2, 3] table of (coef_xstart, coef_eps, sigma) for the steps
+        from every t to t - 1 and to t - 2, computed once per eta rather than every step.
+        """
+        table = self._pair_coef_tables.get(eta)
+        if table is None:
+            alpha_bar_t1 = self.alphas_cumprod
+            ts = th.arange(self.num_timesteps, device=alpha_bar_t1.device)
+            by_gap = []
+            for gap in (1, 2):
+                # rows with t < gap are never used; clamping just keeps them finite
+                alpha_bar_t2 = alpha_bar_t1[(ts - gap).clamp(min=0)]
+                sigma = (
+                    eta
+                    * th.sqrt((1 - alpha_bar_t2) / (1 - alpha_bar_t1))
+                    * th.sqrt(1 - alpha_bar_t1 / alpha_bar_t2)
+                )
+                coef_xstart = th.sqrt(alpha_bar_t2)
+                coef_eps = th.sqrt(1 - alpha_bar_t2 - sigma ** 2)
+                by_gap.append(th.stack([coef_xstart, coef_eps, sigma], dim=1))
+            table = self._pair_coef_tables[eta] = th.stack(by_gap, dim=1)
+        return table
+
     def prk_sample_loop_progressive(
         self,
         model,
@@ -836,14 +1336,24 @@ class GaussianDiffusion:
         """
         if device is None:
             device = model.device
+        model = self._sampling_model(model)
         assert isinstance(shape, (tuple, list))
         if noise is not None:
             img = noise
         else:
             img = th.randn(*shape, device=device)
+        img = self._match_model_layout(model, img)
+        self._uncond_cache.clear()
         # indices = list(range(self.num_timesteps))[::-1]
         trange = ts_index_range(shape[0], self.num_timesteps, device=device)
-        indices = list(range(2, self.num_timesteps, 2))[::-1]
+        indices = _sampling_indices(self.num_timesteps, 2, 2)
+        # stochastic steps take their noise from a pool refilled by one draw every _NOISE_POOL_STEPS steps;
+        # the pool is stacked along the batch dim so each step's slice keeps img's memory layout
+        batch = img.shape[0]
+        pool_steps = min(len(indices), _NOISE_POOL_STEPS) if eta > 0 else 0
+        if pool_steps:
+            noise_pool = th.empty((pool_steps * batch, *img.shape[1:]), device=img.device, dtype=img.dtype)
+            noise_pool = self._match_model_layout(model, noise_pool)
 
         if progress:
             # Lazy import so that we don't depend on tqdm.
@@ -851,26 +1361,33 @@ class GaussianDiffusion:
 
             indices = tqdm(indices)
 
-        old_eps = []
-        for i in indices:
-            # t = th.tensor([i] * shape[0], device=device)
-            t = trange[i]
-            with th.no_grad():
-                out = self.prk_double_step(
-                    model,
-                    img,
-                    t,
-                    clip_denoised=clip_denoised,
-                    denoised_fn=denoised_fn,
-                    model_kwargs=model_kwargs,
-                    eta=eta,
-                )
-                old_eps.append(out['eps'])
-                # print(('rk', i, [t[0, 0, 0, 0] for t in old_eps]))
-
+        try:
+            for step, i in enumerate(indices):
+                # t = th.tensor([i] * shape[0], device=device)
+                t = trange[i]
+                self._host_t = (t, i)
+                step_noise = None
+                if pool_steps:
+                    k = step % pool_steps
+                    if k == 0:
+                        noise_pool.normal_()
+                    step_noise = noise_pool[k * batch:(k + 1) * batch]
+                with th.inference_mode():
+                    out = self.prk_double_step(
+                        model,
+                        img,
+                        t,
+                        clip_denoised=clip_denoised,
+                        denoised_fn=denoised_fn,
+                        model_kwargs=model_kwargs,
+                        noise=step_noise,
+                        eta=eta,
+                    )
                 yield out
                 img = out["sample"]
-        # return img
+            # return img
+        finally:
+            self._end_sampling()
 
     def prk_sample_loop(
         self,
@@ -915,74 +1432,86 @@ class GaussianDiffusion:
     ):
         if device is None:
             device = model.device
+        model = self._sampling_model(model)
         assert isinstance(shape, (tuple, list))
         if noise is not None:
             img = noise
         else:
             img = th.randn(*shape, device=device)
+        img = self._match_model_layout(model, img)
+        self._uncond_cache.clear()
+        noise_buf = th.empty_like(img)
 
         trange = ts_index_range(shape[0], self.num_timesteps, device=device)
 
-        rk_indices = [self.num_timesteps - j for j in [1, 3, 5]]
-        plms_indices = list(range(1, self.num_timesteps-6, 1))[::-1]
+        # t = T-1, T-3, T-5, then every step from T-7 down to 1
+        rk_indices = _sampling_indices(self.num_timesteps, self.num_timesteps - 5, 2)
+        plms_indices = _sampling_indices(self.num_timesteps - 6, 1, 1)
 
         step_counter = 0
 
-        old_eps = []
-        for i in rk_indices:
-            t = trange[i]
-            with th.no_grad():
-                ddim_fallback = (step_counter < ddim_first_n) or (ddim_last_n is not None and (nsteps - step_counter) < ddim_last_n)
-                out = self.prk_double_step(
-                    model,
-                    img,
-                    t,
-                    clip_denoised=clip_denoised,
-                    denoised_fn=denoised_fn,
-                    model_kwargs=model_kwargs,
-                    eta=eta if ddim_fallback else 0.0,
-                    ddim_fallback=ddim_fallback
-                )
-                old_eps.append(out['eps'])
-                step_counter += 1
+        # the last three eps, oldest first
+        old_eps = _EpsRing(3)
+        try:
+            for i in rk_indices:
+                t = trange[i]
+                self._host_t = (t, i)
+                with th.inference_mode():
+                    ddim_fallback = (step_counter < ddim_first_n) or (ddim_last_n is not None and (nsteps - step_counter) < ddim_last_n)
+                    out = self.prk_double_step(
+                        model,
+                        img,
+                        t,
+                        clip_denoised=clip_denoised,
+                        denoised_fn=denoised_fn,
+                        model_kwargs=model_kwargs,
+                        noise=noise_buf.normal_() if ddim_fallback and eta > 0 else None,
+                        eta=eta if ddim_fallback else 0.0,
+                        ddim_fallback=ddim_fallback
+                    )
+                    old_eps.append(out['eps'])
+                    step_counter += 1
 
                 yield out
                 img = out["sample"]
-        for i in plms_indices:
-            t = trange[i]
-            with th.no_grad():
-                ddim_fallback = (step_counter < ddim_first_n) or (ddim_last_n is not None and (nsteps - step_counter) < ddim_last_n)
-                out = self.plms_steps(
+            for i in plms_indices:
+                t = trange[i]
+                self._host_t = (t, i)
+                with th.inference_mode():
+                    ddim_fallback = (step_counter < ddim_first_n) or (ddim_last_n is not None and (nsteps - step_counter) < ddim_last_n)
+                    out = self.plms_steps(
+                        model,
+                        img,
+                        t,
+                        t2=(t-1).clamp(min=0),
+                        old_eps=old_eps,
+                        clip_denoised=clip_denoised,
+                        denoised_fn=denoised_fn,
+                        model_kwargs=model_kwargs,
+                        noise=noise_buf,
+                        eta=eta if ddim_fallback else 0.0,
+                        ddim_fallback=ddim_fallback,
+                        use_model_var=ddim_fallback,
+                    )
+                    old_eps.append(out['eps'])
+                    step_counter += 1
+
+                yield out
+                img = out["sample"]
+
+            # final step
+            with th.inference_mode():
+                out = self.p_mean_variance(
                     model,
                     img,
-                    t,
-                    t2=(t-1).clamp(min=0),
-                    old_eps=old_eps,
+                    trange[0],
                     clip_denoised=clip_denoised,
                     denoised_fn=denoised_fn,
                     model_kwargs=model_kwargs,
-                    eta=eta if ddim_fallback else 0.0,
-                    ddim_fallback=ddim_fallback,
-                    use_model_var=ddim_fallback,
                 )
-                old_eps.pop(0)
-                old_eps.append(out['eps'])
-                step_counter += 1
-
-                yield out
-                img = out["sample"]
-
-        # final step
-        with th.no_grad():
-            out = self.p_mean_variance(
-                model,
-                img,
-                trange[0],
-                clip_denoised=clip_denoised,
-                denoised_fn=denoised_fn,
-                model_kwargs=model_kwargs,
-            )
             yield {"sample": out["mean"], "pred_xstart": out["pred_xstart"]}
+        finally:
+            self._end_sampling()
 
     def plms_sample_loop(
             self,
@@ -1067,14 +1596,18 @@ class GaussianDiffusion:
         """
         if device is None:
             device = model.device
+        model = self._sampling_model(model)
         assert isinstance(shape, (tuple, list))
         if noise is not None:
             img = noise
         else:
             img = th.randn(*shape, device=device)
+        img = self._match_model_layout(model, img)
+        self._uncond_cache.clear()
+        noise_buf = th.empty_like(img)
 
         trange = ts_index_range(shape[0], self.num_timesteps, device=device)
-        indices = list(range(self.num_timesteps))[::-1]
+        indices = _sampling_indices(self.num_timesteps, 0, 1)
 
         if progress:
             # Lazy import so that we don't depend on tqdm.
@@ -1082,24 +1615,29 @@ class GaussianDiffusion:
 
             indices = tqdm(indices)
 
-        for i in indices:
-            # t = th.tensor([i] * shape[0], device=device)
-            t = trange[i]
-            with th.no_grad():
-                out = self.ddim_sample(
-                    model,
-                    img,
-                    t,
-                    clip_denoised=clip_denoised,
-                    denoised_fn=denoised_fn,
-                    model_kwargs=model_kwargs,
-                    eta=eta,
-                )
+        try:
+            for i in indices:
+                # t = th.tensor([i] * shape[0], device=device)
+                t = trange[i]
+                self._host_t = (t, i)
+                with th.inference_mode():
+                    out = self.ddim_sample(
+                        model,
+                        img,
+                        t,
+                        clip_denoised=clip_denoised,
+                        denoised_fn=denoised_fn,
+                        model_kwargs=model_kwargs,
+                        noise=noise_buf,
+                        eta=eta,
+                    )
                 yield out
                 img = out["sample"]
+        finally:
+            self._end_sampling()
 
     def _vb_terms_bpd(
-        self, model, x_start, x_t, t, clip_denoised=True, model_kwargs=None
+        self, model, x_start, x_t, t, clip_denoised=True, model_kwargs=None, any_t_zero=None
     ):
         """
         Get a term for the variational lower-bound.
@@ -1107,6 +1645,10 @@ class GaussianDiffusion:
         The resulting units are bits (rather than nats, as one might expect).
         This allows for comparison to other papers.
 
+        :param any_t_zero: whether any entry of t is 0, if the caller knows it
+                           on the host. If False, the decoder NLL is skipped.
+                           If None, it is always computed, since reading the
+                           answer back from t would sync with the device.
         :return: a dict with the following keys:
                  - 'output': a shape [N] tensor of NLLs or KLs.
                  - 'pred_xstart': the x_0 predictions.
@@ -1120,13 +1662,16 @@ class GaussianDiffusion:
         kl = normal_kl(
             true_mean, true_log_variance_clipped, out["mean"], out["log_variance"]
         )
-        kl = mean_flat(kl) / np.log(2.0)
+        kl = mean_flat(kl) * _INV_LOG2
+
+        if any_t_zero is not None and not any_t_zero:
+            return {"output": kl, "pred_xstart": out["pred_xstart"]}
 
         decoder_nll = -discretized_gaussian_log_likelihood(
             x_start, means=out["mean"], log_scales=0.5 * out["log_variance"]
         )
         assert decoder_nll.shape == x_start.shape
-        decoder_nll = mean_flat(decoder_nll) / np.log(2.0)
+        decoder_nll = mean_flat(decoder_nll) * _INV_LOG2
 
         # At the first timestep return the decoder NLL,
         # otherwise return KL(q(x_{t-1}|x_t,x_0) || p(x_{t-1}|x_t))
@@ -1200,7 +1745,9 @@ class GaussianDiffusion:
 
                 ## NEW VERSION: 1 / (snr + 1)
                 #  1/(snr + 1) = 1 - alpha_cumprod, percept paper eqn 4 comment
-                recip_snrp1_clipped = self._extract_into_tensor(self.recip_snrp1_clipped, t, model_output.shape)
+                # the weight is constant per sample, so apply it to the [N] means
+                # rather than broadcasting it over the full-size squared error
+                recip_snrp1_clipped, = self._extract_many(("recip_snrp1_clipped",), t, t.shape)
                 ratio = recip_snrp1_clipped
                 normalizer = self.recip_snrp1_clipped_normalizer
                 # normalizer = 1.
@@ -1208,12 +1755,13 @@ class GaussianDiffusion:
                 target = noise
                 mse_base = (target - model_output) ** 2
                 ratio_weights = ratio / normalizer
-                terms["mse"] = mean_flat(ratio_weights * mse_base)
+                terms["mse"] = mean_flat(mse_base) * ratio_weights
             elif self.loss_type == LossType.RESCALED_MSE_V:
                 # don't this this is correct...
                 pred_xstart = self._predict_xstart_from_eps(x_t=x_t, t=t, eps=model_output)
-                v_alpha = self._extract_into_tensor(self.sqrt_alphas_cumprod, t, pred_xstart.shape)
-                v_sigma = self._extract_into_tensor(self.sqrt_one_minus_alphas_cumprod, t, pred_xstart.shape)
+                v_alpha, v_sigma = self._extract_many(
+                    ("sqrt_alphas_cumprod", "sqrt_one_minus_alphas_cumprod"), t, pred_xstart.shape
+                )
                 v = v_alpha * model_output - v_sigma * pred_xstart
                 target = v_alpha * noise - v_sigma * x_start
                 terms["mse"] = mean_flat((target - v) ** 2)
@@ -1257,7 +1805,7 @@ class GaussianDiffusion:
         kl_prior = normal_kl(
             mean1=qt_mean, logvar1=qt_log_variance, mean2=0.0, logvar2=0.0
         )
-        return mean_flat(kl_prior) / np.log(2.0)
+        return mean_flat(kl_prior) * _INV_LOG2
 
     def calc_bpd_loop(self, model, x_start, clip_denoised=True, model_kwargs=None, progress=False):
         """
@@ -1284,7 +1832,7 @@ class GaussianDiffusion:
         xstart_mse = []
         mse = []
 
-        indices = list(range(self.num_timesteps))[::-1]
+        indices = _sampling_indices(self.num_timesteps, 0, 1)
         if progress:
             # Lazy import so that we don't depend on tqdm.
             from tqdm.auto import tqdm
@@ -1304,6 +1852,7 @@ class GaussianDiffusion:
                     t=t_batch,
                     clip_denoised=clip_denoised,
                     model_kwargs=model_kwargs,
+                    any_t_zero=t == 0,
                 )
             vb.append(out["output"])
             xstart_mse.append(mean_flat((out["pred_xstart"] - x_start) ** 2))
@@ -1334,20 +1883,49 @@ class GaussianDiffusion:
                                 dimension equal to the length of timesteps.
         :return: a tensor of shape [batch_size, 1, ...] where the shape has K dims.
         """
-        if self.is_tensorized(timesteps.device):
-            try:
-                res = arr[timesteps]
-            except TypeError as e:
-                print(type(timesteps), type(arr))
-                print((getattr(timesteps, 'device'), timesteps.dtype))
-                print((getattr(arr, 'device'), arr.dtype))
-                raise e
+        if isinstance(arr, th.Tensor) and self.is_tensorized(timesteps.device):
+            # after tensorize() the arrays already live on the right device in the right dtype
+            res = arr.index_select(0, timesteps)
         else:
-            res = th.from_numpy(arr).float().to(device=timesteps.device)[timesteps]
+            res = th.as_tensor(arr).to(device=timesteps.device, dtype=th.float)[timesteps]
+            if not self.is_tensorized(timesteps.device):
+                self.tensorize(timesteps.device)
+        # left unexpanded: arithmetic against broadcast_shape-sized tensors broadcasts it for free
+        return res.view(-1, *([1] * (len(broadcast_shape) - 1)))
+
+    def _extract_many(self, names, timesteps, broadcast_shape):
+        """
+        Like _extract_into_tensor, for several schedule arrays at once.
+
+        Arrays in the stacked schedule table are gathered with a single index_select;
+        any others (float32 tables after a lower precision tensorize) are extracted individually.
+
+        :param names: attribute names of the schedule arrays to extract.
+        :return: a tuple with one [batch_size, 1, ...] tensor per name, each with K dims.
+        """
+        # the sampling loops pass the same timestep tensor to every call within a step,
+        # so results are memoized on its identity; the stored tensor guards against id reuse.
+        # tensorize() clears the memo, so a hit also proves the schedule is on timesteps' device
+        key = (id(timesteps), tuple(broadcast_shape), names)
+        hit = self._extract_memo.get(key)
+        if hit is not None and hit[0] is timesteps:
+            return hit[1]
+
+        if not self.is_tensorized(timesteps.device):
             self.tensorize(timesteps.device)
-        while len(res.shape) < len(broadcast_shape):
-            res = res[..., None]
-        return res.expand(broadcast_shape)
+
+        rows = self._sched.index_select(0, timesteps)
+        rows = rows.view(*rows.shape, *([1] * (len(broadcast_shape) - 1)))
+        cols = self._sched_cols
+        out = tuple(
+            rows[:, cols[name]] if name in cols
+            else self._extract_into_tensor(getattr(self, name), timesteps, broadcast_shape)
+            for name in names
+        )
+        if len(self._extract_memo) >= _EXTRACT_MEMO_SIZE:
+            self._extract_memo.clear()
+        self._extract_memo[key] = (timesteps, out)
+        return out
 
 
 class SimpleForwardDiffusion:
@@ -1380,10 +1958,16 @@ class SimpleForwardDiffusion:
         return self.tensorized_for == device
 
     def tensorize(self, device):
-        arrays = {name: getattr(self, name) for name in vars(self) if isinstance(getattr(self, name), np.ndarray)}
+        arrays = {}
+        for name, value in vars(self).items():
+            if isinstance(value, np.ndarray):
+                arrays[name] = value
+            elif isinstance(value, th.Tensor):
+                # already tensorized, for another device
+                setattr(self, name, value.to(device))
 
-        for name, arr in arrays.items():
-            setattr(self, name, th.from_numpy(arr).to(device=device, dtype=th.float))
+        for name, tensor in _arrays_to_device(arrays, device, th.float).items():
+            setattr(self, name, tensor)
 
         self.tensorized_for = device
 
@@ -1401,10 +1985,12 @@ class SimpleForwardDiffusion:
         if noise is None:
             noise = th.randn_like(x_start)
         assert noise.shape == x_start.shape
-        return (
-            self._extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start
-            + self._extract_into_tensor(self.sqrt_one_minus_alphas_cumprod, t, x_start.shape)
-            * noise
+        coef_shape = (x_start.shape[0],) + (1,) * (x_start.dim() - 1)
+        return _q_sample_core(
+            x_start,
+            noise,
+            self._extract_into_tensor(self.sqrt_alphas_cumprod, t, coef_shape),
+            self._extract_into_tensor(self.sqrt_one_minus_alphas_cumprod, t, coef_shape),
         )
 
     def _extract_into_tensor(self, arr, timesteps, broadcast_shape):
@@ -1417,20 +2003,14 @@ class SimpleForwardDiffusion:
                                 dimension equal to the length of timesteps.
         :return: a tensor of shape [batch_size, 1, ...] where the shape has K dims.
         """
-        if self.is_tensorized(timesteps.device):
-            try:
-                res = arr[timesteps]
-            except TypeError as e:
-                print(type(timesteps), type(arr))
-                print((getattr(timesteps, 'device'), timesteps.dtype))
-                print((getattr(arr, 'device'), arr.dtype))
-                raise e
+        if isinstance(arr, th.Tensor) and self.is_tensorized(timesteps.device):
+            # after tensorize() the arrays already live on the right device in the right dtype
+            res = arr.index_select(0, timesteps)
         else:
-            res = th.from_numpy(arr).to(device=timesteps.device)[timesteps].float()
-            self.tensorize(timesteps.device)
-        while len(res.shape) < len(broadcast_shape):
-            res = res[..., None]
-        return res.expand(broadcast_shape)
+            res = th.as_tensor(arr).to(device=timesteps.device, dtype=th.float)[timesteps]
+            if not self.is_tensorized(timesteps.device):
+                self.tensorize(timesteps.device)
+        return res.view(-1, *([1] * (len(broadcast_shape) - 1)))
 
 
 def ts_index_range(batch_size, maxstep, device):
@@ -1440,9 +2020,12 @@ def ts_index_range(batch_size, maxstep, device):
 @lru_cache(1)
 def _ts_index_range(batch_size, nsteps, device):
     # print(f"_ts_index_range called for {(batch_size, nsteps, device)}")
+    # row i is the batch of timesteps for step i, contiguous, so indexing it is a plain row view
     with th.no_grad():
-        tblock = th.tile(th.arange(nsteps, device=device), (batch_size, 1))
-        ts = []
-        for i in range(0, nsteps):
-            ts.append(tblock[:, i:i+1].view(-1))
-    return ts
+        return th.arange(nsteps, device=device).unsqueeze(1).expand(nsteps, batch_size).contiguous()
+
+
+@lru_cache(maxsize=8)
+def _sampling_indices(num_timesteps, start, stride):
+    # the timesteps range(start, num_timesteps, stride) in sampling (descending) order
+    return tuple(range(start, num_timesteps, stride))[::-1]
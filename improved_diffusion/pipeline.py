@@ -152,6 +152,7 @@ class SamplingModel(nn.Module):
         noise_cond_schedule='cosine',
         noise_cond_steps=1000,
         guidance_scale_txt=None,  # if provided and different from guidance_scale, applied using step drop
+        uncond_cache_stride=0,  # if > 1, reuse the unconditional guidance output across this many model calls
     ):
         # dist_util.setup_dist()
 
@@ -250,6 +251,8 @@ class SamplingModel(nn.Module):
             model_kwargs["guidance_scale"] = guidance_scale
             model_kwargs["guidance_after_step"] = guidance_after_step
             model_kwargs["unconditional_model_kwargs"] = {}
+            if uncond_cache_stride > 1:
+                model_kwargs["uncond_cache_stride"] = uncond_cache_stride
 
             txt_guidance_pdrop = 0.0
             if guidance_scale_txt is not None and guidance_scale_txt != guidance_scale:
@@ -1,3 +1,5 @@
+import math
+
 import numpy as np
 import torch as th
 
@@ -17,16 +19,26 @@ def space_timesteps(num_timesteps, section_counts):
     If the stride is a string starting with "ddim", then the fixed striding
     from the DDIM paper is used, and only one section is allowed.
 
+    If the stride is a string of the form "quadW,N,A", a progressively
+    increasing stride is used instead: the steps are W and every
+    W + floor((r+1)*N + A*r*(r+1)/2) for r = 0, 1, ... below num_timesteps.
+    This keeps steps dense near t = 0, where detail is resolved, and spends
+    fewer of them at high noise levels.
+
     :param num_timesteps: the number of diffusion steps in the original
                           process to divide up.
     :param section_counts: either a list of numbers, or a string containing
                            comma-separated numbers, indicating the step count
                            per section. As a special case, use "ddimN" where N
                            is a number of steps to use the striding from the
-                           DDIM paper.
+                           DDIM paper, or "quadW,N,A" for a quadratically
+                           growing stride.
     :return: a set of diffusion steps from the original process to use.
     """
     if isinstance(section_counts, str):
+        if section_counts.startswith("quad"):
+            start, stride, accel = section_counts[len("quad") :].split(",")
+            return _quadratic_stride_steps(num_timesteps, int(start), int(stride), float(accel))
         if section_counts.startswith("ddim"):
             desired_count = int(section_counts[len("ddim") :])
             for i in range(1, num_timesteps):
@@ -60,6 +72,21 @@ def space_timesteps(num_timesteps, section_counts):
     return set(all_steps)
 
 
+def _quadratic_stride_steps(num_timesteps, start, stride, accel):
+    if not 0 <= start < num_timesteps:
+        raise ValueError(f"start step {start} is outside [0, {num_timesteps})")
+    if stride < 1 or accel < 0:
+        raise ValueError(f"need stride >= 1 and accel >= 0, got {stride} and {accel}")
+    steps = {start}
+    r = 0
+    while True:
+        step = start + int(math.floor((r + 1) * stride + accel * r * (r + 1) / 2))
+        if step >= num_timesteps:
+            return steps
+        steps.add(step)
+        r += 1
+
+
 class SpacedDiffusion(GaussianDiffusion):
     """
     A diffusion process which can skip steps in a base diffusion process.
@@ -99,6 +126,12 @@ class SpacedDiffusion(GaussianDiffusion):
     def tensorize_map(self, device):
         # print("SpacedDiffusion tensorize_map called")
         self.timestep_map = th.as_tensor(self.timestep_map, device=device, dtype=th.long)
+        # the model-facing timestep for every spaced step, mapped and rescaled once here
+        # instead of with a gather, a cast and a multiply on every model call
+        if self.rescale_timesteps:
+            self.model_timesteps = self.timestep_map.float() * (1000.0 / self.original_num_steps)
+        else:
+            self.model_timesteps = self.timestep_map
         self.map_tensorized_for = device
 
     def p_mean_variance(
@@ -118,22 +151,36 @@ class SpacedDiffusion(GaussianDiffusion):
         if not self.is_map_tensorized(device):
             self.tensorize_map(device)
         return _WrappedModel(
-            model, self.timestep_map, self.rescale_timesteps, self.original_num_steps
+            model, self.timestep_map, self.rescale_timesteps, self.original_num_steps,
+            model_timesteps=self.model_timesteps,
         )
 
+    def _sampling_model(self, model):
+        # compile the inner module and keep _WrappedModel outermost: p_mean_variance only skips
+        # wrapping (and mapping timesteps) again for a _WrappedModel, and the compile cache is
+        # keyed on the module, which stays the same while pipelines build a new wrapper per call
+        wrapped = self._wrap_model(model)
+        inner = super()._sampling_model(wrapped.model)
+        if inner is wrapped.model:
+            return wrapped
+        return wrapped.with_model(inner)
+
     def _scale_timesteps(self, t):
         # Scaling is done by the wrapped model.
         return t
 
 
 class _WrappedModel:
-    def __init__(self, model, timestep_map, rescale_timesteps, original_num_steps):
+    def __init__(self, model, timestep_map, rescale_timesteps, original_num_steps, model_timesteps=None):
         self.model = model
         self.timestep_map = timestep_map
         self.rescale_timesteps = rescale_timesteps
         self.original_num_steps = original_num_steps
+        self.model_timesteps = model_timesteps
 
     def __call__(self, x, ts, **kwargs):
+        if self.model_timesteps is not None:
+            return self.model(x, self.model_timesteps[ts], **kwargs)
         new_ts = self.timestep_map[ts]
         # map_tensor = th.tensor(self.timestep_map, device=ts.device, dtype=ts.dtype)
         # new_ts = map_tensor[ts]
@@ -141,6 +188,19 @@ class _WrappedModel:
             new_ts = new_ts.float() * (1000.0 / self.original_num_steps)
         return self.model(x, new_ts, **kwargs)
 
+    def __getattr__(self, name):
+        # only reached for attributes the wrapper lacks, e.g. channels_last_mem
+        if name == "model":
+            raise AttributeError(name)
+        return getattr(self.model, name)
+
+    def with_model(self, model):
+        # the same timestep mapping around a different (e.g. compiled) model
+        return _WrappedModel(
+            model, self.timestep_map, self.rescale_timesteps, self.original_num_steps,
+            model_timesteps=self.model_timesteps,
+        )
+
     @property
     def device(self):
         # deep copy
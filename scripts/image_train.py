@@ -37,6 +37,7 @@ def main():
 
     # if args.channels_last_mem:
     #     import improved_diffusion.channels_last_checker
+    #     improved_diffusion.channels_last_checker.enable()
 
     print(f"args.text_lr: {type(args.text_lr)}, {args.text_lr}")
 
@@ -0,0 +1,56 @@
+import pytest
+
+th = pytest.importorskip("torch")
+
+from improved_diffusion import gaussian_diffusion as gd
+from improved_diffusion.respace import SpacedDiffusion, space_timesteps
+
+
+class _EpsModel(th.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.proj = th.nn.Conv2d(3, 3, 1)
+        self.seen_timesteps = set()
+        self.channels_last_inputs = []
+
+    @property
+    def device(self):
+        return self.proj.weight.device
+
+    def forward(self, x, t, **kwargs):
+        self.seen_timesteps.update(t.tolist())
+        self.channels_last_inputs.append(x.is_contiguous(memory_format=th.channels_last))
+        return self.proj(x)
+
+
+def _spaced_diffusion(**kwargs):
+    return SpacedDiffusion(
+        use_timesteps=space_timesteps(1000, "10"),
+        betas=gd.get_named_beta_schedule("linear", 1000),
+        model_mean_type=gd.ModelMeanType.EPSILON,
+        model_var_type=gd.ModelVarType.FIXED_SMALL,
+        loss_type=gd.LossType.MSE,
+        **kwargs,
+    )
+
+
+def test_sampling_dtype_with_prewrapped_model():
+    diffusion = _spaced_diffusion(sampling_dtype=th.bfloat16)
+    model = _EpsModel()
+
+    sample = diffusion.p_sample_loop(diffusion._wrap_model(model), (2, 3, 4, 4), device="cpu")
+
+    assert sample.shape == (2, 3, 4, 4)
+    assert th.isfinite(sample).all()
+    # timesteps are mapped into the original process exactly once
+    assert model.seen_timesteps == set(diffusion.timestep_map.tolist())
+
+
+def test_prewrapped_model_starts_in_channels_last():
+    diffusion = _spaced_diffusion()
+    model = _EpsModel()
+    model.channels_last_mem = True
+
+    diffusion.p_sample_loop(diffusion._wrap_model(model), (2, 3, 4, 4), device="cpu")
+
+    assert all(model.channels_last_inputs)